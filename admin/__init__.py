@@ -1,14 +1,13 @@
+import copy
 import json
 import signal
 import subprocess
-import time
 import sys
-import threading
 import tempfile
 import asyncio
 import aiohttp
 
-from spark import Server
+from spark import Server, ADMIN, DIRECT
 
 
 class State:
@@ -92,23 +91,35 @@ class Limit(State):
         return Welcome(self._config), None
 
 
+class Setup:
+    __slots__ = ('child', 'state', 'timeout')
+
+    def __init__(self, child, state, timeout):
+        self.child = child
+        self.state = state
+        self.timeout = timeout
+
+
+def create_child_config(token, port, basehook, base_config):
+    config = copy.deepcopy(base_config)
+    config['bot'] = {
+        'token': token,
+        'webhook': '{}/{}'.format(basehook, port),
+        'port': port,
+    }
+    return config
+
+
 def create_child_bots(bot_ids, port, basehook, base_config):
-    import copy
     child_bots = {}
     for bot in bot_ids:
         port += 1
-        config = copy.deepcopy(base_config)
-        config['bot'] = {
-            'token': bot['token'],
-            'webhook': '{}/{}'.format(basehook, port),
-            'port': port,
-        }
         child_bots[bot['token']] = {
             'in_use': False,
             'port': port,
             'token': bot['token'],
             'email': bot['email'],
-            'config': config,
+            'config': create_child_config(bot['token'], port, basehook, base_config),
         }
     return child_bots
 
@@ -116,19 +127,21 @@ def create_child_bots(bot_ids, port, basehook, base_config):
 class Admin:
     def __init__(self, config):
         self._max_duration = config.get('max-duration', None)
+        self._setup_timeout = config.get('setup-timeout', 30) * 60
         self._baseconfig = config.get('baseconfig', {})
+        self._basehook = config['bot']['webhook']
 
-        base_hook = config['bot']['webhook']
         initial_port = config['bot']['port']
 
         self._children = create_child_bots(
             config['children'],
             initial_port,
-            base_hook,
+            self._basehook,
             self._baseconfig,
         )
 
         self._states = {}
+        self._running = set()
         self._setup_server(config)
 
     async def proxy_post(self, api, request):
@@ -158,27 +171,40 @@ class Admin:
                 text = await resp.text()
                 return text, resp.status
 
-    async def created(self, api, roomid, membership_id, person):
-        loop = asyncio.get_event_loop()
+    async def proxy_json(self, api, request):
+        child = request.match_info.get('child', None)
+        if not child:
+            return {}, 404
+
+        if not child.isdigit():
+            return {}, 404
+
+        headers = {}
+        if 'Authorization' in request.headers:
+            headers['Authorization'] = request.headers['Authorization']
 
+        data = await request.read()
+        async with aiohttp.ClientSession() as session:
+            async with session.request(
+                    request.method,
+                    'http://127.0.0.1:{}/validate'.format(child),
+                    data=data or None,
+                    headers=headers) as resp:
+                return await resp.json(), resp.status
+
+    async def created(self, api, roomid, membership_id, person):
         if person.id in self._states:
-            await loop.run_in_executor(
-                None,
-                api.messages.create,
-                None,
+            await self._send(
+                api,
                 person.id,
-                None,
                 'Please finish your current instance creation before trying to create a new instance')
             return
 
         child = self._reserve_child()
         if not child:
-            await loop.run_in_executor(
-                None,
-                api.messages.create,
-                None,
+            await self._send(
+                api,
                 person.id,
-                None,
                 'Sorry! I have no more capacity at this point. You can host your own instance by using https://github.com/martiert/spark-bongbot')
             return
 
@@ -187,88 +213,98 @@ class Admin:
         child['config']['administrators'] = person.emails
         child['membership'] = membership_id
         child['owner'] = person.emails[0]
-        self._states[person.id] = {
-            'config': child,
-            'state': Limit(child['config'])
-        }
-        question = self._states[person.id]['state'].ask_question()
-        await loop.run_in_executor(
-            None,
-            api.messages.create,
-            None,
-            person.id,
-            None,
-            question)
+        state = Limit(child['config'])
+        self._states[person.id] = Setup(child, state, self._expire_later(api, person.id))
+        await self._send(api, person.id, state.ask_question())
 
-    def wait_for_timeout(self, child, token, api, subbot_id, parent_id):
-        time.sleep(self._max_duration * 3600)
+    async def stop_after_timeout(self, child, token, api, subbot_id, parent_id):
+        await asyncio.sleep(self._max_duration * 3600)
         child.send_signal(signal.SIGINT)
         self._children[token]['in_use'] = False
 
-        api.memberships.delete(subbot_id)
-        api.memberships.delete(parent_id)
+        await asyncio.gather(
+            self._server.call(ADMIN, api.memberships.delete, subbot_id),
+            self._server.call(ADMIN, api.memberships.delete, parent_id),
+        )
 
     async def answer(self, api, message):
-        loop = asyncio.get_event_loop()
-
-        if message.personId not in self._states:
+        setup = self._states.get(message.personId, None)
+        if not setup:
             return
 
-        next_state, error = self._states[message.personId]['state'].answer(message.text)
+        next_state, error = setup.state.answer(message.text)
         if next_state.done():
-            config = self._states[message.personId]['config']
-            child = self._create_child(config)
-            membership = await loop.run_in_executor(
-                None,
-                api.memberships.create,
-                config['config']['bongs']['room'],
-                None,
-                config['email'])
-            await loop.run_in_executor(
-                None,
-                api.messages.create,
-                None,
-                message.personId,
-                None,
-                'Your instance is created. It will be automatically deleted in {} hours'.format(self._max_duration))
-
-            token = config['token']
-            membership_id = config['membership']
-
             del self._states[message.personId]
-            t = threading.Thread(
-                None,
-                self.wait_for_timeout,
-                "wait thread",
-                (child, token, api, membership.id, membership_id))
-            t.run()
-            t.daemon = True
+            setup.timeout.cancel()
+
+            config = setup.child
+            child = self._create_child(config)
+            membership, _ = await asyncio.gather(
+                self._server.call(
+                    ADMIN,
+                    api.memberships.create,
+                    config['config']['bongs']['room'],
+                    None,
+                    config['email']),
+                self._send(
+                    api,
+                    message.personId,
+                    'Your instance is created. It will be automatically deleted in {} hours'.format(self._max_duration)),
+            )
+
+            stop = asyncio.ensure_future(self.stop_after_timeout(
+                child,
+                config['token'],
+                api,
+                membership.id,
+                config['membership']))
+            self._running.add(stop)
+            stop.add_done_callback(self._running.discard)
             return
 
-        if error:
-            await loop.run_in_executor(
-                None,
-                api.messages.create,
-                None,
-                message.personId,
-                None,
-                error)
+        setup.state = next_state
+        setup.timeout.cancel()
+        setup.timeout = self._expire_later(api, message.personId)
 
         question = next_state.ask_question()
-        self._states[message.personId]['state'] = next_state
+        if error:
+            question = '{}\n\n{}'.format(error, question)
+        await self._send(api, message.personId, question)
 
-        await loop.run_in_executor(
-            None,
+    def _send(self, api, personId, text):
+        return self._server.call(
+            ADMIN,
             api.messages.create,
             None,
-            message.personId,
+            personId,
             None,
-            question)
+            text)
+
+    def _expire_later(self, api, personId):
+        loop = asyncio.get_event_loop()
+        return loop.call_later(self._setup_timeout, self._expire, api, personId)
+
+    def _expire(self, api, personId):
+        setup = self._states.pop(personId, None)
+        if not setup:
+            return
+
+        setup.child['in_use'] = False
+        asyncio.ensure_future(self._send(
+            api,
+            personId,
+            'Your instance creation timed out. Add me to a room again to start over'))
 
     def _reserve_child(self):
         for token, child in self._children.items():
             if not child['in_use']:
-                self._children[token]['in_use'] = True
+                child['in_use'] = True
+                child['config'] = create_child_config(
+                    token,
+                    child['port'],
+                    self._basehook,
+                    self._baseconfig,
+                )
                 return child
         return None
 
@@ -279,9 +315,11 @@ class Admin:
             loop
         )
         self._server.roomcreation(self.created)
-        self._server.default_message(self.answer)
+        self._server.default_message(self.answer, DIRECT)
         self._server.add_post('/{child}', self.proxy_post)
         self._server.add_get('/{child}/validate/{entry}', self.proxy_get)
+        self._server.add_json_get('/{child}/validate', self.proxy_json)
+        self._server.add_json_post('/{child}/validate', self.proxy_json)
 
         loop.run_until_complete(self._server.setup())
 
@@ -0,0 +1,212 @@
+import asyncio
+import gc
+import itertools
+import json
+import os
+import tempfile
+import time
+import types
+import uuid
+
+import PIL.Image
+
+import bongbot
+import replay
+from spark import Server, DIRECT
+
+
+benchmarks = []
+
+
+def benchmark(name, number=100, coroutine=False):
+    def register(setup):
+        benchmarks.append((name, number, coroutine, setup))
+        return setup
+    return register
+
+
+def fake_spark():
+    return replay.FakeSpark([
+        {'api': 'webhooks.list', 'args': [], 'result': []},
+        {'api': 'people.me', 'args': [], 'result': {'id': 'bot', 'displayName': 'Bench (bot)'}},
+    ], False)
+
+
+class Fixtures:
+    def __init__(self):
+        self._directory = tempfile.TemporaryDirectory()
+        self._bots = {}
+        self._servers = []
+        self.calls = 0
+
+    def background(self):
+        path = os.path.join(self._directory.name, 'background.png')
+        if not os.path.exists(path):
+            PIL.Image.new('RGB', (600, 600), 'orange').save(path)
+        return path
+
+    def config(self, **bongs):
+        config = {
+            'bot': {
+                'token': 'benchmark',
+                'webhook': 'http://127.0.0.1/benchmark',
+                'port': 0,
+            },
+            'bongs': {
+                'room': 'room',
+                'welcome_message': 'Welcome',
+                'limit': 1,
+            },
+            'administrators': ['^admin{}@example.com$'.format(i) for i in range(1000)],
+            'ignore': ['^ignored{}@example.com$'.format(i) for i in range(1000)],
+        }
+        config['bongs'].update(bongs)
+        return config
+
+    def bot(self, background=False):
+        if background not in self._bots:
+            bongs = {'background': self.background()} if background else {}
+            self._bots[background] = bongbot.Bongbot(self.config(**bongs), None, fake_spark())
+        return self._bots[background]
+
+    def server(self):
+        server = Server(self.config()['bot'], asyncio.get_event_loop(), fake_spark())
+        self._servers.append(server)
+        return server
+
+    def close(self):
+        for bot in self._bots.values():
+            bot.shutdown()
+        for server in self._servers:
+            server.scheduler.shutdown()
+        self._directory.cleanup()
+
+
+@benchmark('Renderer.bong', 50)
+def render_bong(fixtures):
+    return fixtures.bot()._renderer.bong
+
+
+@benchmark('Renderer.bong with background', 20)
+def render_bong_background(fixtures):
+    return fixtures.bot(True)._renderer.bong
+
+
+@benchmark('Bongbot._allowed with 1000 patterns', 200)
+def allowed(fixtures):
+    bot = fixtures.bot()
+    return lambda: bot._allowed('nobody@example.com')
+
+
+@benchmark('Bongbot._should_ignore with 1000 patterns', 200)
+def should_ignore(fixtures):
+    bot = fixtures.bot()
+    return lambda: bot._should_ignore('nobody@example.com')
+
+
+@benchmark('Server._handle_message with 200 listeners', 500, True)
+def handle_message(fixtures):
+    async def noop(api, message):
+        pass
+
+    server = fixtures.server()
+    for i in range(200):
+        server.listen('^command{}$'.format(i), noop, DIRECT)
+
+    ids = itertools.count()
+    return lambda: server._handle_message(types.SimpleNamespace(
+        id=str(next(ids)),
+        text='command199',
+        roomType=DIRECT,
+    ))
+
+
+@benchmark('Bongbot.validate', 500, True)
+def validate(fixtures):
+    bot = fixtures.bot()
+    store = bot._store.store
+    store.start()
+    store.reserve('person', 1)
+
+    requests = []
+    for _ in range(fixtures.calls):
+        bong_id = str(uuid.uuid4())
+        store.add(bong_id, 'person')
+        requests.append(types.SimpleNamespace(match_info={'entry': bong_id}))
+
+    requests = iter(requests)
+    return lambda: bot.validate(None, next(requests))
+
+
+def measure(fixtures, number, coroutine, setup, repeat):
+    loop = asyncio.get_event_loop()
+    fixtures.calls = number * repeat
+    func = setup(fixtures)
+
+    async def run_coroutines():
+        for _ in range(number):
+            await func()
+
+    def run():
+        for _ in range(number):
+            func()
+
+    best = None
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        for _ in range(repeat):
+            start = time.perf_counter()
+            if coroutine:
+                loop.run_until_complete(run_coroutines())
+            else:
+                run()
+            elapsed = (time.perf_counter() - start) / number
+            best = elapsed if best is None else min(best, elapsed)
+    finally:
+        if enabled:
+            gc.enable()
+    return best
+
+
+def run(pattern=None, repeat=5):
+    fixtures = Fixtures()
+    results = {}
+    try:
+        for name, number, coroutine, setup in benchmarks:
+            if pattern and pattern not in name:
+                continue
+            results[name] = measure(fixtures, number, coroutine, setup, repeat)
+    finally:
+        fixtures.close()
+    return results
+
+
+def load_baseline(path):
+    if not os.path.exists(path):
+        return {}
+    with open(path, 'r') as fd:
+        return json.load(fd)
+
+
+def save_baseline(path, results):
+    baseline = load_baseline(path)
+    baseline.update(results)
+    with open(path, 'w') as fd:
+        json.dump(baseline, fd, indent=2, sort_keys=True)
+        fd.write('\n')
+
+
+def compare(results, baseline, threshold):
+    regressions = []
+    lines = []
+    for name, seconds in results.items():
+        line = '{:<48} {:>10.1f}us'.format(name, seconds * 1e6)
+        if name in baseline:
+            change = seconds / baseline[name] - 1
+            line += ' {:>+7.1%} (baseline {:.1f}us)'.format(change, baseline[name] * 1e6)
+            if change > threshold:
+                regressions.append(name)
+                line += ' REGRESSION'
+        lines.append(line)
+    return lines, regressions
@@ -0,0 +1,55 @@
+import argparse
+import os
+import sys
+
+import benchmarks
+
+
+parser = argparse.ArgumentParser()
+default_baseline = os.path.join(os.path.dirname(__file__), 'baseline.json')
+parser.add_argument(
+    '--baseline',
+    '-b',
+    default=default_baseline,
+    help='Path to the baseline file. Default: {}'.format(default_baseline)
+)
+parser.add_argument(
+    '--threshold',
+    '-t',
+    type=float,
+    default=0.2,
+    help='Allowed slowdown compared to the baseline, 0.2 means 20%%. Default: 0.2',
+)
+parser.add_argument(
+    '--repeat',
+    '-r',
+    type=int,
+    default=5,
+    help='Number of rounds per benchmark, the fastest round is used. Default: 5',
+)
+parser.add_argument(
+    '--filter',
+    '-k',
+    help='Only run benchmarks with this in their name',
+)
+parser.add_argument(
+    '--save',
+    action='store_true',
+    help='Store the results in the baseline file',
+)
+
+args = parser.parse_args()
+
+results = benchmarks.run(args.filter, args.repeat)
+lines, regressions = benchmarks.compare(
+    results,
+    benchmarks.load_baseline(args.baseline),
+    args.threshold,
+)
+print('\n'.join(lines))
+
+if args.save:
+    benchmarks.save_baseline(args.baseline, results)
+elif regressions:
+    print('{} benchmarks regressed more than {:.0%}'.format(len(regressions), args.threshold))
+    sys.exit(1)
@@ -1,16 +1,19 @@
 import asyncio
-import qrcode
+import json
+import os
 import random
 import re
+import signal
 import sys
 import tempfile
-import uuid
 import sre_constants
 
-import PIL.Image
 import ciscosparkapi
 
-from spark import Server
+from spark import Server, EventStream, INTERACTIVE, ADMIN, BULK, DIRECT
+from bongbot import render
+from bongbot.stats import Stats
+from bongbot.store import canonical_id, create_store
 
 validate_html = '''<html>
   <head>
@@ -33,70 +36,134 @@ class StopBongBot(BaseException):
     pass
 
 
-async def get_emails(spark, roomid):
-    loop = asyncio.get_event_loop()
-    members = await loop.run_in_executor(
-        None,
-        spark.memberships.list,
-        roomid,
-        None,
-        None,
-        1000)
+def compile_patterns(patterns):
+    compiled = []
+    for pattern in patterns:
+        try:
+            compiled.append(re.compile(pattern))
+        except sre_constants.error:
+            pass
+    return compiled
+
+
+async def get_members(server, spark, roomid):
+    return await server.call(
+        ADMIN,
+        lambda: list(spark.memberships.list(roomid, None, None, 1000)))
+
+
+async def get_emails(server, spark, roomid):
+    members = await get_members(server, spark, roomid)
     return [member.personEmail for member in members]
 
 
 class Bongbot:
-    def __init__(self, config, owner):
-        self._admins = config.get('administrators', [])
-        self._ignore = config.get('ignore', [])
-        self._bongs = config['bongs']
-        self._draw = config.get('draw', None)
-        self._validate_url = '{}/validate'.format(config['bot']['webhook'])
+    def __init__(self, config, owner, api=None, register=True, serve=True, path=None):
         self._owner = owner
+        self._path = path
+        self._supervised = not register
+        self.killed = False
+        self._bongs = {}
+        self._renderer = None
+        self._validate_url = None
+        self._configure(config)
+        self._store = create_store(config)
+        self._follow_ups = set()
+        self._events = EventStream(lambda: self._stats.snapshot())
+        self._stats = Stats(asyncio.get_event_loop(), self._events, self._store)
+
+        self._setup_server(config, api, register, serve)
+
+    def _configure(self, config):
+        bongs = config['bongs']
+        draw = config.get('draw', None)
+        validate_url = '{}/validate'.format(config['bot']['webhook'])
+
+        renderer = self._renderer
+        if validate_url != self._validate_url or \
+                bongs.get('background', None) != self._bongs.get('background', None) or \
+                bongs.get('encoding', None) != self._bongs.get('encoding', None):
+            renderer = render.Renderer(
+                validate_url,
+                bongs.get('background', None),
+                bongs.get('encoding', None),
+            )
 
-        self._setup_server(config)
+        self._admins = compile_patterns(config.get('administrators', []))
+        self._ignore = compile_patterns(config.get('ignore', []))
+        self._exclude = compile_patterns(draw.get('exclude', []) if draw else [])
+        self._bongs = bongs
+        self._draw = draw
+        self._validate_url = validate_url
+        self._renderer = renderer
 
-        self._valid_bongs = {}
-        self._people = {}
-        self._validated = []
+    async def apply(self, config):
+        self._configure(config)
+        return await self._server.update(config['bot'])
 
-        self._background = None
-        background = self._bongs.get('background', None)
-        if background:
-            self._background = PIL.Image.open(self._bongs['background'])
-            self._foreground = PIL.Image.new(
-                self._background.mode,
-                self._background.size,
-                'black',
-            )
+    async def reload(self):
+        with open(self._path, 'r') as fd:
+            config = json.load(fd)
+        return await self.apply(config)
 
-    async def kill(self, spark, message):
+    async def reload_command(self, spark, message):
         if not self._allowed(message.personEmail):
             return
 
-        loop = asyncio.get_event_loop()
-        await loop.run_in_executor(
+        if self._supervised:
+            os.kill(os.getppid(), signal.SIGHUP)
+            response = 'Reloading the configuration in all workers'
+        elif not self._path:
+            response = 'This instance has no configuration file to reload'
+        else:
+            try:
+                ignored = await self.reload()
+                response = 'Configuration reloaded'
+                if ignored:
+                    response += '. Restart the bot to change {}'.format(', '.join(ignored))
+            except (OSError, ValueError, KeyError) as e:
+                response = 'Could not reload the configuration: {}'.format(e)
+
+        await self._server.call(
+            ADMIN,
+            spark.messages.create,
             None,
+            message.personId,
+            None,
+            response)
+
+    async def _reload_on_signal(self):
+        try:
+            ignored = await self.reload()
+            if ignored:
+                print('Restart the bot to change {}'.format(', '.join(ignored)))
+        except (OSError, ValueError, KeyError):
+            print(sys.exc_info())
+
+    async def kill(self, spark, message):
+        if not self._allowed(message.personEmail):
+            return
+
+        await self._server.call(
+            ADMIN,
             spark.messages.create,
             None,
             None,
             message.personEmail,
             'Instance deleted. Thank you!')
 
-        raise StopBongBot()
+        self.killed = True
+        asyncio.get_event_loop().stop()
 
     async def started(self, spark):
-        loop = asyncio.get_event_loop()
-
         message = '''
 Hi. You're the owner of this instance.
 <br/><br/>
 - To start the party, write **party!**
 - When it's over, please write **kill!** to free the instance
 '''
-        loop = asyncio.get_event_loop()
-        await loop.run_in_executor(
-            None,
+        await self._server.call(
+            ADMIN,
             spark.messages.create,
             None,
             None,
@@ -108,16 +175,9 @@ Hi. You're the owner of this instance.
         if not self._allowed(message.personEmail):
             return
 
-        self._server.listen(
-            '^bong$',
-            self.create_bong,
-        )
-        self._server.listen(
-            '^count$',
-            self.count,
-        )
+        await self._store.start()
 
-        members = await get_emails(spark, self._bongs['room'])
+        members = await get_members(self._server, spark, self._bongs['room'])
 
         msg = '''{}
 <br/>
@@ -130,22 +190,29 @@ To get something to drink, write **bong** to me and show the QR code in the bar!
 It is a one time code, and you will not get a drink for it after it has been used!
 '''.format(self._bongs['welcome_message'])
 
-        await self._notify_all(members, msg, spark)
+        failed = await self._notify_all([m.personEmail for m in members], msg, spark)
 
-        loop = asyncio.get_event_loop()
-        await loop.run_in_executor(
-            None,
+        done = 'Done sending notifications'
+        if failed:
+            done += '. {} notifications could not be sent'.format(failed)
+        await self._server.call(
+            ADMIN,
             spark.messages.create,
             None,
             message.personId,
             None,
-            'Done sending notifications')
+            done)
+
+        if self._bongs.get('preissue', None):
+            self._follow_up(self._preissue(spark, members, message.personId))
 
     async def create_bong(self, spark, message):
-        if self._all_bongs_created(message.personId):
-            loop = asyncio.get_event_loop()
-            await loop.run_in_executor(
-                None,
+        if not await self._store.started():
+            return
+
+        if not await self._store.reserve(message.personId, self._bongs.get('limit', None)):
+            await self._server.call(
+                INTERACTIVE,
                 spark.messages.create,
                 None,
                 message.personId,
@@ -156,32 +223,69 @@ It is a one time code, and you will not get a drink for it after it has been use
         await self._send_new_bong(spark, message.personId)
 
     async def count(self, spark, message):
-        if not self._allowed(message.personEmail):
+        if not await self._store.started() or not self._allowed(message.personEmail):
             return
 
-        loop = asyncio.get_event_loop()
-        await loop.run_in_executor(
-            None,
+        await self._server.call(
+            ADMIN,
             spark.messages.create,
             None,
             message.personId,
             None,
-            'There have been a total of {} bongs validated'.format(
-                len(self._validated)
+            'There have been a total of {} bongs validated. {}'.format(
+                await self._store.validated(),
+                self._stats.images(),
             )
         )
 
+    async def queues(self, spark, message):
+        if not self._allowed(message.personEmail):
+            return
+
+        lines = [
+            '- {}: {} queued, {}/{} running'.format(
+                name,
+                stats['queued'],
+                stats['running'],
+                stats['limit'])
+            for name, stats in self._server.scheduler.stats().items()
+        ]
+        await self._server.call(
+            ADMIN,
+            spark.messages.create,
+            None,
+            message.personId,
+            None,
+            None,
+            'Outbound queues:\n\n{}'.format('\n'.join(lines)))
+
+    async def stalls(self, spark, message):
+        if not self._allowed(message.personEmail):
+            return
+
+        if self._server.watchdog:
+            report = '```\n{}\n```'.format(self._server.watchdog.report(3))
+        else:
+            report = 'Stall detection is not enabled'
+
+        await self._server.call(
+            ADMIN,
+            spark.messages.create,
+            None,
+            message.personId,
+            None,
+            None,
+            report)
+
     async def validate(self, spark, request):
         entry = request.match_info.get('entry', None)
-        if not entry or not self._valid_bongs.get(entry, None):
+        personId = (await self._store.claim(canonical_id(entry))) if entry else None
+        if not personId:
             text = validate_html.format(text='Invalid QR code', color='red')
             return text, 404
 
-        personId = self._valid_bongs[entry]
-        del self._valid_bongs[entry]
-        self._validated.append(entry)
-
-        if not self._all_bongs_created(personId):
+        self._stats.validate()
+        if await self._store.reserve(personId, self._bongs.get('limit', None)):
             await self._send_new_bong(spark, personId)
 
         text = validate_html.format(
@@ -190,16 +294,51 @@ It is a one time code, and you will not get a drink for it after it has been use
         )
         return text, 200
 
+    async def validate_many(self, spark, request):
+        try:
+            data = await request.json()
+            bong_ids = data['ids']
+        except (ValueError, KeyError, TypeError):
+            bong_ids = None
+        if not isinstance(bong_ids, list) or not all(isinstance(bong_id, str) for bong_id in bong_ids):
+            return {'error': 'Expected a json object with a list of ids'}, 400
+
+        batch_limit = self._bongs.get('batch_limit', 1000)
+        if len(bong_ids) > batch_limit:
+            return {'error': 'At most {} ids can be validated at once'.format(batch_limit)}, 413
+
+        people = await self._store.claim_many([canonical_id(bong_id) for bong_id in bong_ids])
+        self._stats.validate(sum(1 for personId in people if personId))
+
+        limit = self._bongs.get('limit', None)
+        for personId in people:
+            if personId and await self._store.reserve(personId, limit):
+                self._follow_up(self._send_new_bong(spark, personId))
+
+        results = [
+            {'id': bong_id, 'valid': bool(personId)}
+            for bong_id, personId in zip(bong_ids, people)
+        ]
+        return {'results': results}, 200
+
+    async def valid_bongs(self, spark, request):
+        token = self._bongs.get('scanner_token', None)
+        if not token:
+            return {'error': 'Not enabled'}, 404
+        if request.headers.get('Authorization', None) != 'Bearer {}'.format(token):
+            return {'error': 'Unauthorized'}, 401
+
+        return {'valid': await self._store.outstanding()}, 200
+
     async def draw(self, spark, message):
-        if not self._allowed(message.personEmail):
+        if not self._draw or not self._allowed(message.personEmail):
             return
 
         completers = await self._get_completers(spark)
 
         if not completers:
-            loop = asyncio.get_event_loop()
-            await loop.run_in_executor(
-                None,
+            await self._server.call(
+                ADMIN,
                 spark.messages.create,
                 None,
                 message.personId,
@@ -210,24 +349,98 @@ It is a one time code, and you will not get a drink for it after it has been use
         winner = random.choice(completers)
         await self._notify_winner(winner, spark, message.personId)
 
-    def _all_bongs_created(self, personId):
+    async def _send_new_bong(self, spark, personId):
+        bong_id, data, seconds = self._renderer.bong()
+        self._stats.encoded(len(data), seconds)
+        if not await self._send_bong(data, bong_id, personId, spark):
+            await self._store.release(personId)
+
+    def _follow_up(self, coroutine):
+        follow_up = asyncio.ensure_future(coroutine)
+        self._follow_ups.add(follow_up)
+        follow_up.add_done_callback(self._follow_ups.discard)
+
+    async def _preissue(self, spark, members, adminId):
         limit = self._bongs.get('limit', None)
-        return limit and self._people.get(personId, 0) >= self._bongs['limit']
+        people = [
+            m.personId for m in members
+            if m.personId != self._server.id() and not self._should_ignore(m.personEmail)
+        ]
+
+        jobs = []
+        for _ in range(self._bongs['preissue']):
+            for personId in people:
+                if await self._store.reserve(personId, limit):
+                    jobs.append(personId)
+        if not jobs:
+            return
 
-    async def _send_new_bong(self, spark, personId):
-        self._people[personId] = self._people.get(personId, 0) + 1
-        bong_id, img = self._create_new_bong()
-        if not await self._send_bong(img, bong_id, personId, spark):
-            self._people[personId] = self._people[personId] - 1
+        await self._server.call(
+            ADMIN,
+            spark.messages.create,
+            None,
+            adminId,
+            None,
+            'Pre-issuing {} bongs to {} people'.format(len(jobs), len(people)))
+
+        progress = {'done': 0, 'failed': 0, 'step': max(1, len(jobs) // 10)}
+        window = asyncio.Semaphore(4 * (os.cpu_count() or 1))
+        pool = render.pool(
+            self._validate_url,
+            self._bongs.get('background', None),
+            self._bongs.get('encoding', None),
+        )
+        try:
+            await asyncio.gather(*[
+                self._preissue_bong(spark, personId, pool, window, adminId, progress, len(jobs))
+                for personId in jobs
+            ], return_exceptions=True)
+        finally:
+            pool.shutdown()
+
+        await self._server.call(
+            ADMIN,
+            spark.messages.create,
+            None,
+            adminId,
+            None,
+            'Done pre-issuing bongs: {} sent, {} failed'.format(
+                progress['done'] - progress['failed'],
+                progress['failed']))
 
-    async def _send_bong(self, image, bong_id, personId, spark):
+    async def _preissue_bong(self, spark, personId, pool, window, adminId, progress, total):
         loop = asyncio.get_event_loop()
+        async with window:
+            try:
+                bong_id, data, seconds = await loop.run_in_executor(pool, render.render)
+                self._stats.encoded(len(data), seconds)
+                sent = await self._send_bong(data, bong_id, personId, spark, BULK, False)
+            except Exception:
+                self._stats.fail()
+                sent = False
+
+        if not sent:
+            await self._store.release(personId)
+            progress['failed'] += 1
+        progress['done'] += 1
+
+        if progress['done'] % progress['step'] == 0 and progress['done'] < total:
+            await self._server.call(
+                ADMIN,
+                spark.messages.create,
+                None,
+                adminId,
+                None,
+                'Pre-issued {}/{} bongs'.format(progress['done'], total))
+
+    async def _send_bong(self, data, bong_id, personId, spark, priority=INTERACTIVE, apologize=True):
         with tempfile.NamedTemporaryFile(suffix='.png') as fd:
-            image.save(fd)
+            fd.write(data)
+            fd.flush()
 
             try:
-                await loop.run_in_executor(
-                    None,
+                await self._server.call(
+                    priority,
                     spark.messages.create,
                     None,
                     personId,
@@ -235,12 +448,15 @@ It is a one time code, and you will not get a drink for it after it has been use
                     'Here is your new bong, show this to the bartender when you want a new drink',
                     None,
                     [fd.name])
-                self._valid_bongs[bong_id] = personId
+                await self._store.add(bong_id, personId)
+                self._stats.issue()
                 return True
             except ciscosparkapi.exceptions.SparkApiError:
-                self._people[personId] -= 1
-                await loop.run_in_executor(
-                    None,
+                self._stats.fail()
+                if not apologize:
+                    return False
+                await self._server.call(
+                    priority,
                     spark.messages.create,
                     None,
                     personId,
@@ -248,37 +464,22 @@ It is a one time code, and you will not get a drink for it after it has been use
                     'I\'m sorry, something went wrong when trying to send the bong to spark. Please try again')
                 return False
 
-    def _create_new_bong(self):
-        bong_id = str(uuid.uuid4())
-
-        qr = qrcode.QRCode(border=0)
-        qr.add_data('{}/{}'.format(self._validate_url, bong_id))
-        qr.make()
-        if self._background:
-            mask = qr.make_image()
-            mask = mask.resize(self._background.size)
-            img = PIL.Image.composite(self._background, self._foreground, mask)
-        else:
-            img = qr.make_image()
-        return bong_id, img
-
     async def _get_completers(self, spark):
         rooms = self._draw.get('rooms', [])
 
         first_room = rooms[0]
         rooms = rooms[1:]
-        possible = set(await get_emails(spark, first_room))
+        possible = set(await get_emails(self._server, spark, first_room))
 
         for room in rooms:
-            needed = set(await get_emails(spark, room))
+            needed = set(await get_emails(self._server, spark, room))
             possible = possible.intersection(needed)
 
         return [email for email in possible if not self._should_exclude(email)]
 
     async def _notify_winner(self, winner, spark, personId):
-        loop = asyncio.get_event_loop()
-        people = await loop.run_in_executor(
-            None,
+        people = await self._server.call(
+            ADMIN,
             spark.people.list,
             winner)
 
@@ -286,15 +487,15 @@ It is a one time code, and you will not get a drink for it after it has been use
             winner_message = '''Congratulations {}! You won'''.format(p.displayName)
             response = 'The winner is {} ({})'.format(p.displayName, p.emails[0])
 
-            await loop.run_in_executor(
-                None,
+            await self._server.call(
+                ADMIN,
                 spark.messages.create,
                 None,
                 personId,
                 None,
                 response)
-            await loop.run_in_executor(
-                None,
+            await self._server.call(
+                ADMIN,
                 spark.messages.create,
                 None,
                 None,
@@ -303,82 +504,111 @@ It is a one time code, and you will not get a drink for it after it has been use
             return
 
     async def _notify_all(self, members, message, spark):
-        loop = asyncio.get_event_loop()
-        for email in members:
-            if self._should_ignore(email):
-                continue
-
-            await loop.run_in_executor(
-                None,
+        notifications = [
+            self._server.call(
+                BULK,
                 spark.messages.create,
                 None,
                 None,
                 email,
                 None,
                 message)
+            for email in members if not self._should_ignore(email)
+        ]
+        results = await asyncio.gather(*notifications, return_exceptions=True)
+        return sum(1 for result in results if isinstance(result, Exception))
 
     def _allowed(self, email):
-        for admin in self._admins:
-            try:
-                if re.match(admin, email):
-                    return True
-            except sre_constants.error:
-                pass
-        return False
+        return any(admin.match(email) for admin in self._admins)
 
     def _should_ignore(self, email):
-        for ignore in self._ignore:
-            try:
-                if re.match(ignore, email):
-                    return True
-            except sre_constants.error:
-                pass
-        return False
+        return any(ignore.match(email) for ignore in self._ignore)
 
     def _should_exclude(self, email):
-        for exclude in self._draw.get('exclude', []):
-            try:
-                if re.match(exclude, email):
-                    return True
-            except sre_constants.error:
-                pass
-        return False
+        return any(exclude.match(email) for exclude in self._exclude)
 
-    def _setup_server(self, config):
+    def _setup_server(self, config, api, register, serve):
         loop = asyncio.get_event_loop()
         self._server = Server(
             config['bot'],
-            loop
+            loop,
+            api,
+            self._store.seen,
         )
 
         self._server.listen(
             '^party!$',
             self.party,
+            DIRECT,
         )
         self._server.listen(
             '^kill!$',
             self.kill,
+            DIRECT,
+        )
+        self._server.listen(
+            '^queues$',
+            self.queues,
+            DIRECT,
+        )
+        self._server.listen(
+            '^stalls$',
+            self.stalls,
+            DIRECT,
+        )
+        self._server.listen(
+            '^bong$',
+            self.create_bong,
+            DIRECT,
+        )
+        self._server.listen(
+            '^count$',
+            self.count,
+            DIRECT,
+        )
+        self._server.listen(
+            '^reload!$',
+            self.reload_command,
+            DIRECT,
+        )
+        self._server.listen(
+            '^draw$',
+            self.draw,
+            DIRECT,
         )
         self._server.add_get('/validate/{entry}', self.validate)
+        self._server.add_json_post('/validate', self.validate_many)
+        self._server.add_json_get('/validate', self.valid_bongs)
+        self._server.add_events('/events', self._events)
 
         if self._owner:
             self._server.on_startup(self.started)
 
-        if self._draw:
-            self._server.listen('^draw$', self.draw)
+        loop.run_until_complete(self._server.setup(register, serve))
+
+    async def outstanding(self):
+        return await self._store.outstanding()
 
-        loop.run_until_complete(self._server.setup())
+    def shutdown(self):
+        loop = asyncio.get_event_loop()
+        loop.run_until_complete(self._server.cleanup())
+        self._store.close()
 
     def run(self):
         loop = asyncio.get_event_loop()
+        if self._path:
+            loop.add_signal_handler(
+                signal.SIGHUP,
+                lambda: asyncio.ensure_future(self._reload_on_signal()),
+            )
         print('======== Bot Ready ========')
         try:
             loop.run_forever()
-        except KeyboardInterrupt:
-            pass
-        except StopBongBot:
-            pass
+        except (KeyboardInterrupt, StopBongBot):
+            return True
         except:
             print(sys.exc_info())
+            return False
         finally:
-            loop.run_until_complete(self._server.cleanup())
+            self.shutdown()
+        return self.killed
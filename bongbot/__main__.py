@@ -1,8 +1,10 @@
 import json
 import argparse
 import os
+import sys
 
 import bongbot
+from bongbot.supervisor import Supervisor
 
 
 parser = argparse.ArgumentParser()
@@ -23,13 +25,32 @@ parser.add_argument(
     help='Remove the config file after run',
 )
 
-args = parser.parse_args()
+parser.add_argument(
+    '--worker',
+    action='store_true',
+    help=argparse.SUPPRESS,
+)
+
+
+def main():
+    args = parser.parse_args()
+
+    with open(args.config, 'r') as fd:
+        config = json.load(fd)
+
+    if args.worker:
+        bot = bongbot.Bongbot(config, None, register=False, path=args.config)
+        sys.exit(0 if bot.run() else 1)
+
+    if config['bot'].get('workers', 1) > 1:
+        bot = Supervisor(config, args.owner, args.config)
+    else:
+        bot = bongbot.Bongbot(config, args.owner, path=args.config)
+    bot.run()
 
-with open(args.config, 'r') as fd:
-    config = json.load(fd)
+    if args.cleanup:
+        os.unlink(args.config)
 
-bot = bongbot.Bongbot(config, args.owner)
-bot.run()
 
-if args.cleanup:
-    os.unlink(args.config)
+if __name__ == '__main__':
+    main()
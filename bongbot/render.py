@@ -0,0 +1,95 @@
+import concurrent.futures
+import io
+import multiprocessing
+import time
+import uuid
+
+import qrcode
+import PIL.Image
+
+
+class Renderer:
+    def __init__(self, validate_url, background=None, encoding=None):
+        encoding = encoding or {}
+        self._validate_url = validate_url
+        self._compact = encoding.get('mode', 'compact') == 'compact'
+        self._colors = min(256, max(2, encoding.get('colors', 64)))
+        self._compress_level = encoding.get('compress_level', 9)
+        self._box_size = encoding.get('box_size', 10)
+
+        self._background = None
+        if background:
+            self._background = PIL.Image.open(background)
+            if self._compact:
+                self._compact_layers(encoding.get('size', None))
+            else:
+                self._foreground = PIL.Image.new(
+                    self._background.mode,
+                    self._background.size,
+                    'black',
+                )
+
+    def _compact_layers(self, size):
+        background = self._background.convert('RGB')
+        if size:
+            background.thumbnail((size, size))
+
+        background = background.quantize(self._colors - 1)
+        black = self._colors - 1
+        palette = background.getpalette()[:3 * black] + [0, 0, 0]
+        background.putpalette(palette)
+
+        foreground = PIL.Image.new('P', background.size, black)
+        foreground.putpalette(palette)
+
+        self._background = background
+        self._foreground = foreground
+
+    def create(self):
+        bong_id = str(uuid.uuid4())
+
+        qr = qrcode.QRCode(border=0, box_size=self._box_size)
+        qr.add_data('{}/{}'.format(self._validate_url, bong_id))
+        qr.make()
+        if self._background:
+            mask = qr.make_image()
+            mask = mask.resize(self._background.size)
+            img = PIL.Image.composite(self._background, self._foreground, mask)
+        else:
+            img = qr.make_image()
+        return bong_id, img
+
+    def encode(self, image):
+        data = io.BytesIO()
+        if self._compact:
+            image.save(data, 'PNG', optimize=True, compress_level=self._compress_level)
+        else:
+            image.save(data, 'PNG')
+        return data.getvalue()
+
+    def bong(self):
+        bong_id, image = self.create()
+        start = time.perf_counter()
+        data = self.encode(image)
+        return bong_id, data, time.perf_counter() - start
+
+
+_renderer = None
+
+
+def _start_worker(validate_url, background, encoding):
+    global _renderer
+    _renderer = Renderer(validate_url, background, encoding)
+
+
+def render():
+    return _renderer.bong()
+
+
+def pool(validate_url, background=None, encoding=None, processes=None):
+    return concurrent.futures.ProcessPoolExecutor(
+        processes,
+        multiprocessing.get_context('forkserver'),
+        initializer=_start_worker,
+        initargs=(validate_url, background, encoding),
+    )
@@ -0,0 +1,80 @@
+import asyncio
+import collections
+import time
+
+
+class Stats:
+    def __init__(self, loop, stream, store, interval=0.5):
+        self._loop = loop
+        self._stream = stream
+        self._store = store
+        self._interval = interval
+        self._pending = False
+        self.failed = 0
+        self._images = 0
+        self._image_bytes = 0
+        self._encode_seconds = 0
+        self._seconds = collections.deque()
+        self._last_minute = {'issued': 0, 'validated': 0}
+
+    def issue(self):
+        self._count('issued', 1)
+
+    def validate(self, count=1):
+        if not count:
+            return
+        self._count('validated', count)
+
+    def fail(self):
+        self.failed += 1
+        self._changed()
+
+    def encoded(self, size, seconds):
+        self._images += 1
+        self._image_bytes += size
+        self._encode_seconds += seconds
+
+    def images(self):
+        if not self._images:
+            return 'No bong images encoded yet'
+        return 'Bong images are {:.1f} kB on average and took {:.1f} ms to encode'.format(
+            self._image_bytes / self._images / 1024,
+            self._encode_seconds / self._images * 1000,
+        )
+
+    def _count(self, name, count):
+        now = int(time.monotonic())
+        self._expire(now)
+        if not self._seconds or self._seconds[-1][0] != now:
+            self._seconds.append([now, {'issued': 0, 'validated': 0}])
+        self._seconds[-1][1][name] += count
+        self._last_minute[name] += count
+        self._changed()
+
+    def _expire(self, now):
+        while self._seconds and self._seconds[0][0] <= now - 60:
+            _, counts = self._seconds.popleft()
+            for name, count in counts.items():
+                self._last_minute[name] -= count
+
+    def _changed(self):
+        if not self._pending:
+            self._pending = True
+            self._loop.call_later(self._interval, lambda: asyncio.ensure_future(self._publish()))
+
+    async def _publish(self):
+        self._pending = False
+        self._stream.publish(await self.snapshot())
+
+    async def snapshot(self):
+        issued, validated = await self._store.totals()
+        self._expire(int(time.monotonic()))
+        return {
+            'issued': issued,
+            'validated': validated,
+            'outstanding': issued - validated,
+            'failed': self.failed,
+            'last_minute': dict(self._last_minute),
+            'image_bytes': self._image_bytes // self._images if self._images else 0,
+            'encode_ms': round(self._encode_seconds / self._images * 1000, 2) if self._images else 0,
+        }
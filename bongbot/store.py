@@ -0,0 +1,280 @@
+import array
+import asyncio
+import concurrent.futures
+import contextlib
+import sqlite3
+import sys
+import uuid
+
+
+def canonical_id(bong_id):
+    try:
+        return str(uuid.UUID(bong_id))
+    except ValueError:
+        return bong_id
+
+
+class MemoryStore:
+    # Bongs are numbered in the order they are issued. Their uuids are kept
+    # as 16 bytes each in one bytearray, the owner as a 4 byte person handle
+    # and the spent flag as one bit. An open addressing table of 4 byte bong
+    # numbers, kept between a quarter and half full, maps uuids to bong
+    # numbers. That is 28 to 36 bytes per bong, depending on how full the
+    # table is, and independent of how long the person ids are. When the
+    # table grows, the old one is kept until every bong has been moved, a
+    # few bongs per add, so no single add rehashes the whole table.
+    def __init__(self):
+        self._started = False
+        self._handles = {}
+        self._people = []
+        self._issued = array.array('I')
+        self._ids = bytearray()
+        self._owners = array.array('I')
+        self._spent = bytearray()
+        self._table = array.array('i', [-1]) * 1024
+        self._old_table = None
+        self._moving = 0
+        self._moved = 0
+        self._count = 0
+        self._validated = 0
+        self._messages = set()
+
+    def start(self):
+        self._started = True
+
+    def started(self):
+        return self._started
+
+    def _handle(self, personId):
+        handle = self._handles.get(personId, None)
+        if handle is None:
+            handle = len(self._people)
+            personId = sys.intern(personId)
+            self._handles[personId] = handle
+            self._people.append(personId)
+            self._issued.append(0)
+        return handle
+
+    def issued(self, personId):
+        handle = self._handles.get(personId, None)
+        return 0 if handle is None else self._issued[handle]
+
+    def reserve(self, personId, limit):
+        handle = self._handle(personId)
+        if limit and self._issued[handle] >= limit:
+            return False
+        self._issued[handle] += 1
+        return True
+
+    def release(self, personId):
+        self._issued[self._handles[personId]] -= 1
+
+    def _slot(self, table, key):
+        mask = len(table) - 1
+        slot = int.from_bytes(key[:8], 'little') & mask
+        while True:
+            number = table[slot]
+            if number < 0 or self._ids[number * 16:number * 16 + 16] == key:
+                return slot
+            slot = (slot + 1) & mask
+
+    def _find(self, key):
+        number = self._table[self._slot(self._table, key)]
+        if number < 0 and self._old_table is not None:
+            number = self._old_table[self._slot(self._old_table, key)]
+        return number
+
+    def _grow(self):
+        while self._old_table is not None:
+            self._move(self._moving)
+        self._old_table = self._table
+        self._moving = self._count
+        self._moved = 0
+        self._table = array.array('i', [-1]) * (len(self._table) * 2)
+
+    def _move(self, count):
+        end = min(self._moved + count, self._moving)
+        for number in range(self._moved, end):
+            self._table[self._slot(self._table, self._ids[number * 16:number * 16 + 16])] = number
+        self._moved = end
+        if end == self._moving:
+            self._old_table = None
+
+    def add(self, bong_id, personId):
+        key = uuid.UUID(bong_id).bytes
+        if 2 * (self._count + 1) > len(self._table):
+            self._grow()
+
+        number = self._count
+        self._ids += key
+        self._owners.append(self._handle(personId))
+        if number % 8 == 0:
+            self._spent.append(0)
+        self._table[self._slot(self._table, key)] = number
+        self._count += 1
+        if self._old_table is not None:
+            self._move(8)
+
+    def _spent_bit(self, number):
+        return self._spent[number >> 3] & (1 << (number & 7))
+
+    def claim(self, bong_id):
+        try:
+            key = uuid.UUID(bong_id).bytes
+        except ValueError:
+            return None
+
+        number = self._find(key)
+        if number < 0 or self._spent_bit(number):
+            return None
+
+        self._spent[number >> 3] |= 1 << (number & 7)
+        self._validated += 1
+        return self._people[self._owners[number]]
+
+    def claim_many(self, bong_ids):
+        return [self.claim(bong_id) for bong_id in bong_ids]
+
+    def validated(self):
+        return self._validated
+
+    def totals(self):
+        return self._count, self._validated
+
+    def outstanding(self):
+        count = self._count
+        spent = bytes(self._spent)
+        ids = bytes(self._ids[:count * 16]).hex()
+        valid = []
+        for index, byte in enumerate(spent):
+            if byte == 0xff:
+                continue
+            for number in range(index * 8, min(index * 8 + 8, count)):
+                if not byte & (1 << (number & 7)):
+                    p = number * 32
+                    valid.append('%s-%s-%s-%s-%s' % (
+                        ids[p:p + 8], ids[p + 8:p + 12], ids[p + 12:p + 16], ids[p + 16:p + 20], ids[p + 20:p + 32]))
+        return valid
+
+    def seen(self, message_id):
+        if message_id in self._messages:
+            return True
+        self._messages.add(message_id)
+        return False
+
+
+class SharedStore:
+    def __init__(self, path):
+        self._db = sqlite3.connect(path, timeout=30, isolation_level=None, check_same_thread=False)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        with self._transaction():
+            self._db.execute('CREATE TABLE IF NOT EXISTS state (key TEXT PRIMARY KEY, value TEXT)')
+            self._db.execute('CREATE TABLE IF NOT EXISTS people (id TEXT PRIMARY KEY, issued INTEGER)')
+            self._db.execute('CREATE TABLE IF NOT EXISTS bongs (id TEXT PRIMARY KEY, person TEXT)')
+            self._db.execute('CREATE TABLE IF NOT EXISTS validated (id TEXT PRIMARY KEY)')
+            self._db.execute('CREATE TABLE IF NOT EXISTS messages (id TEXT PRIMARY KEY)')
+            self._db.execute(
+                "INSERT OR IGNORE INTO state SELECT 'validated', COUNT(*) FROM validated")
+            self._db.execute(
+                "INSERT OR IGNORE INTO state SELECT 'issued', "
+                "(SELECT COUNT(*) FROM bongs) + (SELECT value FROM state WHERE key = 'validated')")
+
+    @contextlib.contextmanager
+    def _transaction(self):
+        self._db.execute('BEGIN IMMEDIATE')
+        try:
+            yield
+        except BaseException:
+            self._db.execute('ROLLBACK')
+            raise
+        self._db.execute('COMMIT')
+
+    def start(self):
+        self._db.execute("INSERT OR REPLACE INTO state VALUES ('started', '1')")
+
+    def started(self):
+        row = self._db.execute("SELECT value FROM state WHERE key = 'started'").fetchone()
+        return row is not None
+
+    def issued(self, personId):
+        row = self._db.execute('SELECT issued FROM people WHERE id = ?', (personId,)).fetchone()
+        return row[0] if row else 0
+
+    def reserve(self, personId, limit):
+        with self._transaction():
+            issued = self.issued(personId)
+            if limit and issued >= limit:
+                return False
+            self._db.execute('INSERT OR REPLACE INTO people VALUES (?, ?)', (personId, issued + 1))
+        return True
+
+    def release(self, personId):
+        self._db.execute('UPDATE people SET issued = issued - 1 WHERE id = ?', (personId,))
+
+    def _increment(self, counter):
+        self._db.execute('UPDATE state SET value = value + 1 WHERE key = ?', (counter,))
+
+    def add(self, bong_id, personId):
+        with self._transaction():
+            self._db.execute('INSERT INTO bongs VALUES (?, ?)', (bong_id, personId))
+            self._increment('issued')
+
+    def _claim(self, bong_id):
+        row = self._db.execute('SELECT person FROM bongs WHERE id = ?', (bong_id,)).fetchone()
+        if not row:
+            return None
+        self._db.execute('DELETE FROM bongs WHERE id = ?', (bong_id,))
+        self._db.execute('INSERT INTO validated VALUES (?)', (bong_id,))
+        self._increment('validated')
+        return row[0]
+
+    def claim(self, bong_id):
+        with self._transaction():
+            return self._claim(bong_id)
+
+    def claim_many(self, bong_ids):
+        with self._transaction():
+            return [self._claim(bong_id) for bong_id in bong_ids]
+
+    def validated(self):
+        return self.totals()[1]
+
+    def totals(self):
+        rows = dict(self._db.execute("SELECT key, CAST(value AS INTEGER) FROM state WHERE key IN ('issued', 'validated')"))
+        return rows['issued'], rows['validated']
+
+    def outstanding(self):
+        return [row[0] for row in self._db.execute('SELECT id FROM bongs')]
+
+    def seen(self, message_id):
+        cursor = self._db.execute('INSERT OR IGNORE INTO messages VALUES (?)', (message_id,))
+        return cursor.rowcount == 0
+
+
+class AsyncStore:
+    def __init__(self, store, executor=None, background=()):
+        self.store = store
+        self._executor = executor
+        self._background = background
+
+    def __getattr__(self, name):
+        method = getattr(self.store, name)
+
+        async def call(*args):
+            if not self._executor and name not in self._background:
+                return method(*args)
+            loop = asyncio.get_event_loop()
+            return await loop.run_in_executor(self._executor, method, *args)
+        return call
+
+    def close(self):
+        if self._executor:
+            self._executor.shutdown(wait=True)
+
+
+def create_store(config):
+    path = config['bot'].get('store', None)
+    if path:
+        return AsyncStore(SharedStore(path), concurrent.futures.ThreadPoolExecutor(1))
+    return AsyncStore(MemoryStore(), background=('outstanding',))
@@ -0,0 +1,129 @@
+import asyncio
+import copy
+import json
+import os
+import signal
+import subprocess
+import sys
+import tempfile
+
+from bongbot import Bongbot
+
+
+def worker_path(path, index):
+    base, extension = os.path.splitext(path)
+    return '{}.{}{}'.format(base, index, extension)
+
+
+class Supervisor:
+    def __init__(self, config, owner, path=None):
+        self._workers = []
+        self._config_files = []
+        self._store = None
+        self._path = path
+
+        if not config['bot'].get('store', None):
+            fd, self._store = tempfile.mkstemp(suffix='.sqlite')
+            os.close(fd)
+
+        config = self._prepare(config)
+        for index in range(config['bot']['workers']):
+            self._config_files.append(self._write_config(config, index))
+
+        self._bot = Bongbot(self._supervisor_config(config), owner, serve=False)
+
+    def _prepare(self, config):
+        config = copy.deepcopy(config)
+        if self._store:
+            config['bot']['store'] = self._store
+        return config
+
+    def _supervisor_config(self, config):
+        config = copy.deepcopy(config)
+        config['bot'].pop('record', None)
+        return config
+
+    def _write_config(self, config, index, name=None):
+        config = copy.deepcopy(config)
+        if config['bot'].get('record', None):
+            config['bot']['record'] = worker_path(config['bot']['record'], index)
+
+        with tempfile.NamedTemporaryFile(mode='w', suffix='.json', delete=False) as fp:
+            json.dump(config, fp)
+        if name:
+            os.replace(fp.name, name)
+            return name
+        return fp.name
+
+    async def _reload(self):
+        try:
+            with open(self._path, 'r') as fd:
+                config = self._prepare(json.load(fd))
+            ignored = await self._bot.apply(self._supervisor_config(config))
+        except (OSError, ValueError, KeyError):
+            print(sys.exc_info())
+            return
+
+        if ignored:
+            print('Restart the bot to change {}'.format(', '.join(ignored)))
+        for index, name in enumerate(self._config_files):
+            self._write_config(config, index, name)
+        for worker in self._workers:
+            if worker.poll() is None:
+                worker.send_signal(signal.SIGHUP)
+
+    def _spawn(self, index):
+        return subprocess.Popen([
+            sys.executable,
+            '-m', 'bongbot',
+            '--worker',
+            '--config', self._config_files[index],
+        ])
+
+    async def _watch(self):
+        while True:
+            await asyncio.sleep(1)
+            for index, worker in enumerate(self._workers):
+                code = worker.poll()
+                if code is None:
+                    continue
+                if code == 0:
+                    return
+                print('Worker {} exited with {}, restarting'.format(index, code))
+                self._workers[index] = self._spawn(index)
+
+    def _stop(self):
+        for worker in self._workers:
+            if worker.poll() is None:
+                worker.send_signal(signal.SIGINT)
+        for worker in self._workers:
+            try:
+                worker.wait(10)
+            except subprocess.TimeoutExpired:
+                worker.kill()
+
+        for name in self._config_files:
+            os.unlink(name)
+        if self._store:
+            for suffix in ('', '-wal', '-shm'):
+                if os.path.exists(self._store + suffix):
+                    os.unlink(self._store + suffix)
+
+    def run(self):
+        loop = asyncio.get_event_loop()
+        self._workers = [self._spawn(index) for index in range(len(self._config_files))]
+        if self._path:
+            loop.add_signal_handler(
+                signal.SIGHUP,
+                lambda: asyncio.ensure_future(self._reload()),
+            )
+        print('======== Bot Ready ({} workers) ========'.format(len(self._workers)))
+        try:
+            loop.run_until_complete(self._watch())
+        except KeyboardInterrupt:
+            pass
+        except:
+            print(sys.exc_info())
+        finally:
+            self._stop()
+            self._bot.shutdown()
@@ -0,0 +1,220 @@
+import asyncio
+import collections
+import functools
+import gzip
+import json
+import re
+import threading
+import time
+import types
+
+import aiohttp
+
+
+validate_path = re.compile('^/validate/(?P<entry>[^/?]+)')
+
+
+def load(path):
+    if path.endswith('.gz'):
+        fd = gzip.open(path, 'rt')
+    else:
+        fd = open(path, 'r')
+
+    with fd:
+        return [json.loads(line) for line in fd if line.strip()]
+
+
+def to_object(value):
+    if isinstance(value, dict):
+        return types.SimpleNamespace(**value)
+    if isinstance(value, list):
+        return [to_object(v) for v in value]
+    return value
+
+
+async def nothing():
+    return []
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+class FakeResource:
+    def __init__(self, spark, name):
+        self._spark = spark
+        self._name = name
+
+    def __getattr__(self, attribute):
+        return functools.partial(
+            self._spark.call,
+            '{}.{}'.format(self._name, attribute),
+        )
+
+
+class FakeSpark:
+    def __init__(self, entries, latency=True):
+        self._latency = latency
+        self._lock = threading.Lock()
+        self._exact = collections.defaultdict(collections.deque)
+        self._any = {}
+        self.calls = collections.Counter()
+
+        for entry in entries:
+            if 'api' not in entry or 'error' in entry:
+                continue
+            key = (entry['api'], json.dumps(entry['args'], default=str))
+            self._exact[key].append(entry)
+            self._any.setdefault(entry['api'], entry)
+
+    def __getattr__(self, name):
+        return FakeResource(self, name)
+
+    def call(self, name, *args):
+        key = (name, json.dumps(list(args), default=str))
+        with self._lock:
+            self.calls[name] += 1
+            recorded = self._exact.get(key, None)
+            if recorded and len(recorded) > 1:
+                entry = recorded.popleft()
+            elif recorded:
+                entry = recorded[0]
+            else:
+                entry = self._any.get(name, None)
+
+        if not entry:
+            return [] if name.endswith('.list') else None
+
+        if self._latency:
+            time.sleep(entry.get('duration', 0))
+        return to_object(entry['result'])
+
+    def report(self):
+        return '\n'.join(
+            '{:>24} {:>8}'.format(name, count)
+            for name, count in sorted(self.calls.items())
+        )
+
+
+class Replayer:
+    def __init__(self, entries, port, speed=1.0, outstanding=None, token=None):
+        self._requests = [e for e in entries if 'webhook' in e or 'get' in e or 'json' in e]
+        self._headers = {'Authorization': 'Bearer {}'.format(token)} if token else {}
+        self._url = 'http://127.0.0.1:{}'.format(port)
+        self._speed = speed
+        self._outstanding = outstanding or nothing
+        self._bongs = {}
+        self._fresh = collections.deque()
+        self._used = set()
+        self._bot_loop = None
+        self._refill = None
+        self._latencies = collections.defaultdict(list)
+        self._duration = 0
+
+    async def run(self):
+        if not self._requests:
+            return
+
+        self._bot_loop = asyncio.get_event_loop()
+        await self._bot_loop.run_in_executor(None, self._run_client)
+
+    def _run_client(self):
+        loop = asyncio.new_event_loop()
+        try:
+            loop.run_until_complete(self._replay())
+        finally:
+            loop.close()
+
+    async def _replay(self):
+        loop = asyncio.get_event_loop()
+        self._refill = asyncio.Lock()
+        first = self._requests[0]['t']
+        start = loop.time()
+        async with aiohttp.ClientSession() as session:
+            pending = []
+            for entry in self._requests:
+                delay = (entry['t'] - first) / self._speed - (loop.time() - start)
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                pending.append(asyncio.ensure_future(self._send(session, entry)))
+            await asyncio.gather(*pending)
+        self._duration = loop.time() - start
+
+    async def _send(self, session, entry):
+        start = time.monotonic()
+        if 'webhook' in entry:
+            kind = 'webhook {}'.format(entry['webhook'].get('resource', ''))
+            async with session.post(self._url + '/', json=entry['webhook']) as resp:
+                await resp.read()
+        elif 'json' in entry:
+            request = entry['json']
+            body = await self._map_body(request['body'])
+            async with session.request(
+                request['method'],
+                self._url + request['path'],
+                data=body,
+                headers=dict(self._headers, **{'Content-Type': 'application/json'}),
+            ) as resp:
+                await resp.read()
+                kind = 'json {} {}'.format(request['method'].lower(), resp.status)
+        else:
+            kind = 'get'
+            async with session.get(self._url + await self._map(entry['get'])) as resp:
+                await resp.read()
+                kind = 'get {}'.format(resp.status)
+        self._latencies[kind].append(time.monotonic() - start)
+
+    async def _map(self, path):
+        match = validate_path.match(path)
+        if not match:
+            return path
+
+        entry = match.group('entry')
+        return path.replace(entry, await self._map_id(entry), 1)
+
+    async def _map_body(self, body):
+        try:
+            data = json.loads(body)
+            ids = data['ids']
+        except (ValueError, KeyError, TypeError):
+            return body
+        if not isinstance(ids, list):
+            return body
+
+        data['ids'] = [await self._map_id(entry) if isinstance(entry, str) else entry for entry in ids]
+        return json.dumps(data)
+
+    async def _map_id(self, entry):
+        if entry not in self._bongs:
+            async with self._refill:
+                if not self._fresh:
+                    outstanding = asyncio.run_coroutine_threadsafe(self._outstanding(), self._bot_loop)
+                    for bong_id in await asyncio.wrap_future(outstanding):
+                        if bong_id not in self._used:
+                            self._fresh.append(bong_id)
+            if self._fresh and entry not in self._bongs:
+                bong_id = self._fresh.popleft()
+                self._used.add(bong_id)
+                self._bongs[entry] = bong_id
+        return self._bongs.get(entry, entry)
+
+    def report(self):
+        lines = ['Replayed {} requests in {:.2f}s (recorded {:.2f}s at {}x)'.format(
+            len(self._requests),
+            self._duration,
+            self._requests[-1]['t'] - self._requests[0]['t'] if self._requests else 0,
+            self._speed,
+        )]
+        for kind, values in sorted(self._latencies.items()):
+            lines.append(
+                '{:>24} n={:<6} mean={:.1f}ms p50={:.1f}ms p95={:.1f}ms max={:.1f}ms'.format(
+                    kind,
+                    len(values),
+                    1000 * sum(values) / len(values),
+                    1000 * percentile(values, 0.5),
+                    1000 * percentile(values, 0.95),
+                    1000 * max(values),
+                )
+            )
+        return '\n'.join(lines)
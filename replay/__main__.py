@@ -0,0 +1,70 @@
+import json
+import argparse
+import asyncio
+
+import bongbot
+import replay
+
+
+parser = argparse.ArgumentParser()
+parser.add_argument(
+    '--config',
+    '-c',
+    required=True,
+    help='Path to the bongbot configuration file to replay against',
+)
+parser.add_argument(
+    '--log',
+    '-l',
+    required=True,
+    help='Path to a log recorded with the "record" bot setting',
+)
+parser.add_argument(
+    '--speed',
+    '-s',
+    type=float,
+    default=1.0,
+    help='Replay speed, 2 replays the traffic twice as fast as recorded. Default: 1',
+)
+parser.add_argument(
+    '--no-latency',
+    action='store_true',
+    help='Answer Spark API calls immediately instead of with the recorded latency',
+)
+
+
+def main():
+    args = parser.parse_args()
+
+    with open(args.config, 'r') as fd:
+        config = json.load(fd)
+    config['bot'].pop('record', None)
+
+    entries = replay.load(args.log)
+    spark = replay.FakeSpark(entries, not args.no_latency)
+
+    bot = bongbot.Bongbot(config, None, spark, register=False)
+    replayer = replay.Replayer(
+        entries,
+        config['bot']['port'],
+        args.speed,
+        bot.outstanding,
+        config['bongs'].get('scanner_token', None),
+    )
+
+    loop = asyncio.get_event_loop()
+    try:
+        loop.run_until_complete(replayer.run())
+    except RuntimeError:
+        if not bot.killed:
+            raise
+    finally:
+        bot.shutdown()
+
+    print(replayer.report())
+    print('Spark API calls:')
+    print(spark.report())
+
+
+if __name__ == '__main__':
+    main()
@@ -1,37 +1,336 @@
 import re
+import collections
 import functools
 import asyncio
+import concurrent.futures
+import gzip
+import json
+import queue
+import sys
+import threading
+import time
+import traceback
 from aiohttp import web
 
 import ciscosparkapi
 
 
+INTERACTIVE = 0
+ADMIN = 1
+BULK = 2
+
+DIRECT = 'direct'
+GROUP = 'group'
+
+restart_settings = (
+    'token',
+    'port',
+    'workers',
+    'store',
+    'record',
+    'concurrency',
+    'watchdog',
+)
+
+priority_names = {
+    INTERACTIVE: 'interactive',
+    ADMIN: 'admin',
+    BULK: 'bulk',
+}
+
+
 async def dummy(*args, **kwargs):
     pass
 
 
+def _accepts(listening, room_type):
+    return listening is None or room_type is None or listening == room_type
+
+
+class Scheduler:
+    def __init__(self, loop, config=None):
+        config = config or {}
+        threads = config.get('threads', 8)
+        self._loop = loop
+        self._executor = concurrent.futures.ThreadPoolExecutor(threads)
+        self._free = threads
+        self._limits = {
+            INTERACTIVE: config.get('interactive', threads),
+            ADMIN: config.get('admin', max(1, threads // 2)),
+            BULK: config.get('bulk', max(1, threads // 2)),
+        }
+        self._queues = {priority: collections.deque() for priority in self._limits}
+        self._running = {priority: 0 for priority in self._limits}
+
+    def run(self, priority, func, *args):
+        future = self._loop.create_future()
+        self._queues[priority].append((future, func, args))
+        self._dispatch()
+        return future
+
+    def stats(self):
+        return {
+            priority_names[priority]: {
+                'queued': len(self._queues[priority]),
+                'running': self._running[priority],
+                'limit': self._limits[priority],
+            }
+            for priority in sorted(self._queues)
+        }
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False)
+
+    def _dispatch(self):
+        for priority in sorted(self._queues):
+            pending = self._queues[priority]
+            while pending and self._free and self._running[priority] < self._limits[priority]:
+                future, func, args = pending.popleft()
+                if future.cancelled():
+                    continue
+
+                self._free -= 1
+                self._running[priority] += 1
+                call = self._loop.run_in_executor(self._executor, func, *args)
+                call.add_done_callback(functools.partial(self._done, priority, future))
+
+    def _done(self, priority, future, call):
+        self._free += 1
+        self._running[priority] -= 1
+        if not future.cancelled():
+            if call.cancelled():
+                future.cancel()
+            elif call.exception():
+                future.set_exception(call.exception())
+            else:
+                future.set_result(call.result())
+        self._dispatch()
+
+
+def to_json(value):
+    if hasattr(value, 'json_data'):
+        return value.json_data
+    if isinstance(value, (list, tuple)):
+        return [to_json(v) for v in value]
+    return value
+
+
+class Recorder:
+    def __init__(self, path):
+        if path.endswith('.gz'):
+            self._fd = gzip.open(path, 'wt')
+        else:
+            self._fd = open(path, 'w')
+        self._entries = queue.Queue()
+        self._start = time.monotonic()
+        self._writer = threading.Thread(target=self._write_entries, name='recorder', daemon=True)
+        self._writer.start()
+
+    def webhook(self, data):
+        self._write({'webhook': data})
+
+    def get(self, path):
+        self._write({'get': path})
+
+    def json(self, method, path, body):
+        self._write({'json': {'method': method, 'path': path, 'body': body}})
+
+    def call(self, name, func, *args):
+        start = time.monotonic()
+        entry = {'api': name, 'args': list(args)}
+        try:
+            result = func(*args)
+            if not isinstance(result, (list, str)) and hasattr(result, '__iter__') \
+                    and not hasattr(result, 'json_data'):
+                result = list(result)
+            entry['result'] = to_json(result)
+            return result
+        except Exception as e:
+            entry['error'] = str(e)
+            raise
+        finally:
+            entry['duration'] = round(time.monotonic() - start, 4)
+            self._write(entry)
+
+    def close(self):
+        self._entries.put(None)
+        self._writer.join()
+        self._fd.close()
+
+    def _write(self, entry):
+        entry['t'] = round(time.monotonic() - self._start, 4)
+        self._entries.put(entry)
+
+    def _write_entries(self):
+        while True:
+            entry = self._entries.get()
+            if entry is None:
+                return
+            self._fd.write(json.dumps(entry, separators=(',', ':'), default=str))
+            self._fd.write('\n')
+            if self._entries.empty():
+                self._fd.flush()
+
+
+class RecordingAPI:
+    def __init__(self, target, recorder, name=None):
+        self._target = target
+        self._recorder = recorder
+        self._name = name
+
+    def __getattr__(self, attribute):
+        value = getattr(self._target, attribute)
+        name = attribute if not self._name else '{}.{}'.format(self._name, attribute)
+        if callable(value):
+            return functools.partial(self._recorder.call, name, value)
+        return RecordingAPI(value, self._recorder, name)
+
+
+class Watchdog:
+    def __init__(self, loop, config):
+        self._loop = loop
+        self._interval = config.get('interval', 0.05)
+        self._threshold = config.get('threshold', 0.1)
+        self._depth = config.get('depth', 12)
+        self.token = config.get('token', None)
+        self._lock = threading.Lock()
+        self._stalls = {}
+        self._beat = time.monotonic()
+        self._last_stall = None
+        self._thread_id = None
+        self._handle = None
+        self._running = False
+
+    def start(self):
+        self._running = True
+        self._heartbeat()
+        threading.Thread(target=self._sample, name='watchdog', daemon=True).start()
+
+    def stop(self):
+        self._running = False
+        if self._handle:
+            self._handle.cancel()
+
+    def _heartbeat(self):
+        self._thread_id = threading.get_ident()
+        self._beat = time.monotonic()
+        self._handle = self._loop.call_later(self._interval, self._heartbeat)
+
+    def _sample(self):
+        while self._running:
+            time.sleep(self._interval)
+            beat = self._beat
+            lag = time.monotonic() - beat - self._interval
+            if lag < self._threshold:
+                continue
+
+            frame = sys._current_frames().get(self._thread_id, None)
+            if frame is None:
+                continue
+            stack = ''.join(traceback.format_list(
+                traceback.extract_stack(frame, self._depth)
+            ))
+            del frame
+
+            with self._lock:
+                stall = self._stalls.setdefault(stack, {
+                    'stalls': 0,
+                    'samples': 0,
+                    'max_lag': 0,
+                })
+                if self._last_stall != (beat, stack):
+                    stall['stalls'] += 1
+                    self._last_stall = (beat, stack)
+                stall['samples'] += 1
+                stall['max_lag'] = max(stall['max_lag'], lag)
+
+    def stalls(self):
+        with self._lock:
+            stalls = [dict(stall, stack=stack) for stack, stall in self._stalls.items()]
+        return sorted(stalls, key=lambda s: s['samples'], reverse=True)
+
+    def report(self, limit=5):
+        stalls = self.stalls()
+        if not stalls:
+            return 'No event loop stalls over {}ms detected'.format(int(self._threshold * 1000))
+
+        lines = ['{} blocking call sites, {} stalls over {}ms'.format(
+            len(stalls),
+            sum(s['stalls'] for s in stalls),
+            int(self._threshold * 1000),
+        )]
+        for stall in stalls[:limit]:
+            lines.append('')
+            lines.append('{} stalls, {} samples, max lag {}ms:'.format(
+                stall['stalls'],
+                stall['samples'],
+                int(stall['max_lag'] * 1000),
+            ))
+            lines.append(stall['stack'])
+        return '\n'.join(lines)
+
+
+class EventStream:
+    def __init__(self, current, keepalive=15):
+        self._current = current
+        self._queues = set()
+        self.keepalive = keepalive
+
+    async def current(self):
+        return await self._current()
+
+    def subscribe(self):
+        subscriber = asyncio.Queue(1)
+        self._queues.add(subscriber)
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        self._queues.discard(subscriber)
+
+    def publish(self, data):
+        for subscriber in self._queues:
+            if subscriber.full():
+                subscriber.get_nowait()
+            subscriber.put_nowait(data)
+
+
 class Server:
-    def __init__(self, config, loop):
+    def __init__(self, config, loop, api=None, seen=None):
         self._loop = loop
         self._config = config
         self._id = None
         self._displayname = None
-        self._api = ciscosparkapi.CiscoSparkAPI(access_token=config['token'])
+        self._api = api or ciscosparkapi.CiscoSparkAPI(access_token=config['token'])
+        self._recorder = None
+        if config.get('record', None):
+            self._recorder = Recorder(config['record'])
+            self._api = RecordingAPI(self._api, self._recorder)
+        self.scheduler = Scheduler(loop, config.get('concurrency', None))
+        self.watchdog = None
+        if config.get('watchdog', None):
+            self.watchdog = Watchdog(loop, config['watchdog'])
         self._callbacks = []
         self._hooks = {}
         self._get_routes = {}
         self._post_routes = {}
+        self._json_routes = {}
+        self._event_routes = {}
         self._default_message = dummy
+        self._default_room_type = None
         self._pre_message = dummy
         self._on_startup = dummy
         self._on_room_created = dummy
-        self._messages = []
+        self._messages = set()
+        self._fetching = set()
+        self._seen = seen or self._remember
+        self._registered = False
 
-    def listen(self, match, callback):
-        self._callbacks.append((re.compile(match), callback))
+    def listen(self, match, callback, room_type=None):
+        self._callbacks.append((re.compile(match), callback, room_type))
 
-    def default_message(self, callback):
+    def default_message(self, callback, room_type=None):
         self._default_message = callback
+        self._default_room_type = room_type
 
     def pre_message(self, callback):
         self._pre_message = callback
@@ -42,28 +341,78 @@ class Server:
     def roomcreation(self, callback):
         self._on_room_created = callback
 
-    async def setup(self):
-        await self.cleanup()
-        await asyncio.wait([self._get_self(), self._register_webhooks()])
-        await self._on_startup(self._api)
-        return await self._setup_webserver()
+    def id(self):
+        return self._id
+
+    def call(self, priority, func, *args):
+        return self.scheduler.run(priority, func, *args)
+
+    async def setup(self, register=True, serve=True):
+        if register:
+            await self._remove_webhooks()
+            await asyncio.gather(self._get_self(), self._register_webhooks())
+            self._registered = True
+            await self._on_startup(self._api)
+        else:
+            await self._get_self()
+            self._register_hooks()
+
+        if self.watchdog:
+            self.watchdog.start()
+
+        if serve:
+            return await self._setup_webserver()
+
+    async def update(self, config):
+        ignored = [
+            key for key in restart_settings
+            if config.get(key, None) != self._config.get(key, None)
+        ]
+        webhook_changed = config['webhook'] != self._config['webhook']
+
+        config = dict(config)
+        for key in restart_settings:
+            config[key] = self._config.get(key, None)
+        self._config = config
+
+        if webhook_changed and self._registered:
+            await self._remove_webhooks()
+            await self._register_webhooks()
+        return ignored
 
     async def cleanup(self):
-        await self._remove_webhooks()
+        if self.watchdog:
+            self.watchdog.stop()
+        if self._registered:
+            await self._remove_webhooks()
+            self._registered = False
+        if self._recorder:
+            self._recorder.close()
+            self._recorder = None
+        self.scheduler.shutdown()
+
+    async def _remember(self, message_id):
+        if message_id in self._messages:
+            return True
+        self._messages.add(message_id)
+        return False
 
     async def _handle_message(self, message):
-        if message.id in self._messages:
+        if await self._seen(message.id):
             return
-
-        self._messages.append(message.id)
+        self._messages.add(message.id)
 
         text = message.text
+        room_type = getattr(message, 'roomType', None)
 
         await self._pre_message(self._loop, self._api, message)
-        callbacks = [c for c in self._callbacks if c[0].match(text.lower())]
+        callbacks = [
+            c for c in self._callbacks
+            if _accepts(c[2], room_type) and c[0].match(text.lower())
+        ]
         if callbacks:
-            await asyncio.wait(
-                [callback[1](
+            await asyncio.gather(
+                *[callback[1](
                     self._api,
                     message)
                     for callback in callbacks]
@@ -72,23 +421,50 @@ class Server:
             await self._default_message(self._api, message)
 
     async def _message_created(self, webhook_data):
-        if webhook_data['data']['personId'] == self._id:
+        data = webhook_data['data']
+        if data['personId'] == self._id:
             return
 
-        message = await self._loop.run_in_executor(
-            None,
-            self._api.messages.get,
-            webhook_data['data']['id'],
-        )
+        if not self._wants(data.get('roomType', None)):
+            return
+
+        message_id = data['id']
+        if message_id in self._messages or message_id in self._fetching:
+            return
+
+        self._fetching.add(message_id)
+        try:
+            message = await self.call(
+                INTERACTIVE,
+                self._api.messages.get,
+                message_id,
+            )
+        finally:
+            self._fetching.discard(message_id)
 
         await self._handle_message(message)
 
+    def _wants(self, room_type):
+        if self._default_message is not dummy:
+            if _accepts(self._default_room_type, room_type):
+                return True
+        return any(_accepts(c[2], room_type) for c in self._callbacks)
+
+    def _message_filter(self):
+        room_types = set(c[2] for c in self._callbacks)
+        if self._default_message is not dummy:
+            room_types.add(self._default_room_type)
+
+        if len(room_types) == 1 and None not in room_types:
+            return 'roomType={}'.format(room_types.pop())
+        return None
+
     async def _room_created(self, webhook_data):
         if not webhook_data['data']['personId'] == self._id:
             return
 
-        person = await self._loop.run_in_executor(
-            None,
+        person = await self.call(
+            ADMIN,
             self._api.people.get,
             webhook_data['actorId']
         )
@@ -102,6 +478,8 @@ class Server:
 
     async def _webhook_notified(self, request):
         data = await request.json()
+        if self._recorder:
+            self._recorder.webhook(data)
         name = data['name']
         if name in self._hooks.keys():
             await self._hooks[name](data)
@@ -113,6 +491,8 @@ class Server:
             '/',
             self._webhook_notified
         )
+        if self.watchdog and self.watchdog.token:
+            self._application.router.add_get('/stalls', self._report_stalls)
 
         for route, callback in self._get_routes.items():
             self._application.router.add_get(
@@ -130,16 +510,41 @@ class Server:
                     callback,
                 )
             )
+        for route, stream in self._event_routes.items():
+            self._application.router.add_get(
+                route,
+                functools.partial(
+                    self._handle_events,
+                    stream,
+                )
+            )
+        for (method, route), callback in self._json_routes.items():
+            self._application.router.add_route(
+                method,
+                route,
+                functools.partial(
+                    self._handle_json,
+                    callback,
+                )
+            )
 
         self._handler = self._application.make_handler()
         server = await self._loop.create_server(
             self._handler,
             '127.0.0.1',
             self._config['port'],
+            reuse_port=self._config.get('workers', 1) > 1,
         )
         return server
 
+    async def _report_stalls(self, request):
+        if request.headers.get('Authorization', None) != 'Bearer {}'.format(self.watchdog.token):
+            return web.Response(status=401, text='Unauthorized', content_type='text/plain')
+        return web.Response(text=self.watchdog.report(), content_type='text/plain')
+
     async def _handle_get(self, callback, request):
+        if self._recorder:
+            self._recorder.get(request.path_qs)
         html, code = await callback(self._api, request)
         return web.Response(
             text=html,
@@ -151,20 +556,62 @@ class Server:
         code = await callback(self._api, request)
         return web.Response(status=code)
 
+    async def _handle_json(self, callback, request):
+        if self._recorder:
+            body = await request.text() if request.can_read_body else None
+            self._recorder.json(request.method, request.path_qs, body)
+        data, code = await callback(self._api, request)
+        return web.json_response(data, status=code)
+
+    async def _handle_events(self, stream, request):
+        response = web.StreamResponse(headers={
+            'Content-Type': 'text/event-stream',
+            'Cache-Control': 'no-cache',
+        })
+        await response.prepare(request)
+
+        subscriber = stream.subscribe()
+        try:
+            data = await stream.current()
+            while True:
+                await response.write('data: {}\n\n'.format(json.dumps(data)).encode())
+                try:
+                    data = await asyncio.wait_for(subscriber.get(), stream.keepalive)
+                except asyncio.TimeoutError:
+                    data = await stream.current()
+        except ConnectionResetError:
+            pass
+        finally:
+            stream.unsubscribe(subscriber)
+        return response
+
     def add_get(self, route, callback):
         self._get_routes[route] = callback
 
     def add_post(self, route, callback):
         self._post_routes[route] = callback
 
+    def add_json_get(self, route, callback):
+        self._json_routes[('GET', route)] = callback
+
+    def add_json_post(self, route, callback):
+        self._json_routes[('POST', route)] = callback
+
+    def add_events(self, route, stream):
+        self._event_routes[route] = stream
+
     async def _get_self(self):
-        me = await self._loop.run_in_executor(
-            None,
+        me = await self.call(
+            ADMIN,
             self._api.people.me,
         )
         self._id = me.id
         self._displayname = me.displayName.replace(' (bot)', '')
 
+    def _register_hooks(self):
+        self._hooks['message created'] = self._message_created
+        self._hooks['room created'] = self._room_created
+
     async def _register_webhooks(self):
         if self._callbacks or self._default_message:
             await self._create_webhook(
@@ -172,6 +619,7 @@ class Server:
                 'messages',
                 'created',
                 self._message_created,
+                self._message_filter(),
             )
         if self._on_room_created:
             await self._create_webhook(
@@ -181,26 +629,27 @@ class Server:
                 self._room_created,
             )
 
-    async def _create_webhook(self, name, resource, event, callback):
+    async def _create_webhook(self, name, resource, event, callback, filter=None):
         self._hooks[name] = callback
-        await self._loop.run_in_executor(
-            None,
+        await self.call(
+            ADMIN,
             self._api.webhooks.create,
             name,
             self._config['webhook'],
             resource,
             event,
+            filter,
         )
 
     async def _remove_webhooks(self):
-        hooks = await self._loop.run_in_executor(
-            None,
-            self._api.webhooks.list,
+        hooks = await self.call(
+            ADMIN,
+            lambda: list(self._api.webhooks.list()),
         )
 
         for hook in hooks:
-            await self._loop.run_in_executor(
-                None,
+            await self.call(
+                ADMIN,
                 self._api.webhooks.delete,
                 hook.id
             )